@@ -1,27 +1,29 @@
+import functools
 import numpy as np
-from scipy.special import softmax
 import torch
-from psrcal.utils import onehot_encode, check_label
-import psrcal.calibration as psrcalcal
-import matplotlib.pyplot as plt
+import torch.nn.functional as F
+from psrcal.utils import check_label
 
 def CostFunction(log_probs, labels, C=None, norm=True):
 
     if C is None:
         # Use the standard 0-1 cost matrix
-        C = 1 - np.eye(log_probs.shape[1])    
-
-    # Normalize the cost matrix
-    C -= C.min(axis=0)
-    C = torch.tensor(C, dtype=log_probs.dtype)
+        C, CT = _default_cost(log_probs.shape[1], log_probs.device, log_probs.dtype)
+    else:
+        C = np.asarray(C, dtype=np.float64)
+        C, CT = _normalize_cost(C.tobytes(), C.shape, log_probs.device, log_probs.dtype)
 
     def _decisions(p):
-        return (p @ C.T).argmin(axis=-1)
+        return torch.matmul(p, CT).argmin(axis=-1)
 
-    probs = torch.exp(log_probs)
-    costs = C[_decisions(probs),labels]
+    # The decisions are not differentiable, so there is no need to keep
+    # the posteriors around for backpropagation
+    with torch.no_grad():
+        decisions = _decisions(torch.exp(log_probs))
+    costs = C[decisions,labels]
         
     if norm:
+        # The priors are a single vector, so this is a single decision
         priors = (torch.bincount(labels)/float(labels.shape[0])).type(dtype=C.dtype)
         naive_costs = C[_decisions(priors), labels]
         prior_cost = torch.mean(naive_costs)
@@ -31,51 +33,63 @@ def CostFunction(log_probs, labels, C=None, norm=True):
     return torch.mean(costs)/prior_cost
 
 
+@functools.lru_cache(maxsize=32)
+def _normalize_cost(C_bytes, shape, device, dtype):
+    """Returns the cost matrix with the minimum of each column subtracted,
+    along with its contiguous transpose. Cached since the same few cost
+    matrices are usually evaluated over and over."""
+
+    C = np.frombuffer(C_bytes, dtype=np.float64).reshape(shape)
+    C = torch.tensor(C - C.min(axis=0), dtype=dtype, device=device)
+
+    return C, C.T.contiguous()
+
+
+@functools.lru_cache(maxsize=32)
+def _default_cost(K, device, dtype):
+    """Returns the 0-1 cost matrix for K classes, which is already normalized,
+    along with its transpose."""
+
+    C = 1 - torch.eye(K, dtype=dtype, device=device)
+
+    return C, C.T.contiguous()
+
+
 def LogLoss(log_probs, labels, norm=True, priors=None):
         
-    priors, weights = _get_priors_and_weights(labels, priors)
-    norm_factor = LogLoss(torch.log(priors.expand(log_probs.shape[0],-1)), labels, norm=False, priors=priors) if norm else 1.0
+    priors, weights, present = _get_priors_and_weights(labels, priors)
+    # The normalizer is the loss of a system that always outputs the priors,
+    # which is the entropy of the priors restricted to the classes present
+    # in the data, since only those get samples to weight.
+    norm_factor = -torch.sum(torch.special.xlogy(priors, priors)*present) if norm else 1.0
 
-    # The loss on each sample is weighted by the inverse of the
-    # frequency of the corresponding class in the test data
-    # times the external prior
-    ii = torch.arange(len(labels))
-    losses = -log_probs[ii, labels]
-    wlosses = weights*losses
-    # The line below is to turn to 0 potential infinite losses when the weight is 0.
-    wlosses[weights==0] = 0
-    score  = torch.mean(wlosses)
-
-    return score / norm_factor
+    return _logloss_impl(log_probs, labels, weights) / norm_factor
 
 
 def LogLossSE(log_probs, ref_log_probs, norm=True):
         
+    ref_probs = torch.exp(ref_log_probs)
+
     if norm:
-        priors = torch.mean(torch.exp(ref_log_probs), axis=0)
-        prior_entropy = -torch.sum(priors * torch.log(priors))
+        priors = torch.mean(ref_probs, axis=0)
+        prior_entropy = -torch.sum(torch.special.xlogy(priors, priors))
     else:
         prior_entropy = 1.0
 
-    return torch.mean(torch.sum(-torch.exp(ref_log_probs) * log_probs, axis=1))/ prior_entropy
+    return -torch.sum(ref_probs * log_probs) / log_probs.shape[0] / prior_entropy
 
 
 
 def Brier(log_probs, labels, norm=True, priors=None):
         
-    priors, weights = _get_priors_and_weights(labels, priors)
-    norm_factor = Brier(torch.log(priors.expand(log_probs.shape[0],-1)), labels, norm=False, priors=priors) if norm else 1.0
+    priors, weights, present = _get_priors_and_weights(labels, priors)
+    # The normalizer is the loss of a system that always outputs the priors.
+    # A sample of class k gets a loss of 1 - 2 p_k + ||p||^2, which is weighted
+    # by p_k over the classes present in the data and divided by the number of
+    # priors, since the score of such a system averages over that many entries.
+    norm_factor = torch.sum(priors*present*(1 - 2*priors + torch.sum(priors*priors))) / priors.shape[0] if norm else 1.0
 
-
-    # The loss on each sample is weighted by the inverse of the
-    # frequency of the corresponding class in the test data
-    # times the external prior
-    probs         = torch.exp(log_probs)
-    labels_onehot = onehot_encode(labels, n_classes=probs.shape[-1])
-    losses        = (labels_onehot-probs)**2
-    score         = torch.mean(torch.atleast_2d(weights).T*losses)
-
-    return score / norm_factor
+    return _brier_impl(log_probs, labels, weights) / norm_factor
 
 
 def CalLossLogLoss(log_probs, cal_log_probs, targets, priors=None):
@@ -94,16 +108,149 @@ def CalLossBrier(log_probs, cal_log_probs, targets, priors=None):
     return (raw-cal)/raw*100
 
 
+def _logloss_impl(log_probs, labels, weights):
+
+    # The loss on each sample is weighted by the inverse of the
+    # frequency of the corresponding class in the test data
+    # times the external prior
+    # nll_loss only takes long targets, while indexing also worked with int labels
+    losses = F.nll_loss(log_probs, labels.long(), reduction='none')
+    # The where is to turn to 0 potential infinite losses when the weight is 0.
+    wlosses = torch.where(weights==0, torch.zeros_like(losses), weights*losses)
+    return torch.mean(wlosses)
+
+
+def _brier_impl(log_probs, labels, weights):
+
+    # The loss on each sample is weighted by the inverse of the
+    # frequency of the corresponding class in the test data
+    # times the external prior. The squared distance to the one-hot
+    # label is expanded as ||p||^2 - 2 p_y + 1 so that only the posterior
+    # of the true class is needed. The division by K keeps the mean over
+    # all N*K entries.
+    probs  = torch.exp(log_probs)
+    py     = probs.gather(1, labels.long().unsqueeze(1)).squeeze(1)
+    losses = torch.sum(probs*probs, axis=1) - 2*py + 1
+    return torch.mean(weights*losses) / probs.shape[-1]
+
+
+def _compile_for_cuda(fn):
+    """Wraps fn with torch.compile so that its elementwise ops get fused
+    into a few kernels when the inputs are on the GPU. CPU inputs use the
+    original function, and so do setups where compilation fails."""
+
+    compiled = [None]
+
+    def _fn(log_probs, *args):
+        if not log_probs.is_cuda or compiled[0] is fn:
+            return fn(log_probs, *args)
+
+        try:
+            if compiled[0] is None:
+                compiled[0] = torch.compile(fn, dynamic=True)
+            return compiled[0](log_probs, *args)
+        except Exception:
+            # The compilation happens when the compiled function is called, so this
+            # is where setups not supported by torch.compile fail (eg, no Triton, a
+            # GPU too old for it, or an unsupported Python version). Use the original
+            # function from then on. If the error had nothing to do with the
+            # compilation, the original function raises it again.
+            result = fn(log_probs, *args)
+            compiled[0] = fn
+            return result
+
+    return _fn
+
+
+_logloss_impl = _compile_for_cuda(_logloss_impl)
+_brier_impl = _compile_for_cuda(_brier_impl)
+
+
 def _get_priors_and_weights(labels, priors):
 
-    data_priors = torch.bincount(labels)/float(labels.shape[0])
+    # The counts are accumulated in double precision so that they are exact
+    K = priors.shape[0] if priors is not None else int(labels.max())+1
+    dtype = priors.dtype if priors is not None else torch.get_default_dtype()
+    counts = torch.zeros(K, dtype=torch.float64, device=labels.device)
+    counts.scatter_add_(0, labels.long(), torch.ones_like(labels, dtype=torch.float64))
+    data_priors = (counts/float(labels.shape[0])).type(dtype=dtype)
+    present = counts > 0
+
     if priors is None:
         priors = data_priors
         weights = torch.tensor(1.0)
     else:
-        weights = priors[labels]/data_priors[labels] 
+        weights = (priors/data_priors)[labels]
+
+    return priors, weights, present
+
+
+def _bin_stats(confs, hits, M):
+    """Splits (0, 1] into M equal-width bins according to confs and returns
+    the number of samples in each bin along with the average of confs and
+    hits within it, which is 0 for empty bins. The averages of confs keep
+    the dtype of confs, those of hits use the promoted dtype of confs and
+    hits."""
+
+    dtype = torch.promote_types(confs.dtype, hits.dtype)
+
+    # Since the bins are equidistant, the index of the bin can be computed directly.
+    # The bins are open on the left, so a value of exactly k/M goes in bin k-1.
+    # Rounding in c*M can put values at or right next to an edge one bin off, so
+    # the index is then checked against the edges themselves, which are the same
+    # values the bins were originally defined by.
+    c = confs.detach()
+    edges = _bin_edges(M, c.device, c.dtype)
+    bin_idx = (torch.ceil(c*M)-1).long().clamp_(0, M-1)
+    bin_idx -= (c <= edges[bin_idx]).long()
+    bin_idx += (c > edges[bin_idx+1]).long()
+
+    # Samples outside (0, 1], like posteriors that underflowed to 0, do not belong
+    # to any bin, though they still count in N for the ECE. They are sent to an
+    # extra bin that is discarded below.
+    in_range = (c > 0) & (c <= 1)
+    bin_idx = torch.where(in_range, bin_idx, torch.full_like(bin_idx, M))
+
+    # Accumulate the counts and the sums of confs and hits in a single pass
+    # over the samples, in double precision so that the counts are exact and
+    # the sums accurate even for large bins and low-precision inputs
+    values = torch.stack([torch.ones_like(confs, dtype=torch.float64), confs.double(), hits.double()])
+    sums = torch.zeros(3, M+1, dtype=torch.float64, device=confs.device)
+    sums.scatter_add_(1, bin_idx.expand(3, -1), values)
+    counts, sum_conf, sum_hits = sums[:, :M]
+
+    # Empty bins have sums of 0, so dividing them by 1 gives averages of 0 without
+    # having to select the non-empty bins on the device
+    safe_counts = counts.clamp(min=1)
+
+    return counts.long(), (sum_conf/safe_counts).type(dtype=confs.dtype), (sum_hits/safe_counts).type(dtype=dtype)
+
+
+def _bin_values(ys, xs, counts, M):
 
-    return priors, weights
+    # Move all the per-bin values to the host in a single transfer, then keep the
+    # non-empty bins and go back to the dtype of each of the values
+    values = torch.stack([ys.double(), xs.double(), counts.double()]).detach().cpu()
+    host_ys, host_xs, host_counts = values
+    used = (host_counts > 0).numpy()
+
+    return host_ys.type(dtype=ys.dtype).numpy()[used], host_xs.type(dtype=xs.dtype).numpy()[used], host_counts.long().numpy()[used], _bin_limits(M)[used]
+
+
+@functools.lru_cache(maxsize=32)
+def _bin_edges(M, device, dtype):
+
+    return torch.tensor(np.linspace(0, 1, num=M+1), dtype=dtype, device=device)
+
+
+@functools.lru_cache(maxsize=32)
+def _bin_limits(M):
+
+    limits = np.linspace(0, 1, num=M+1)
+    limits = np.stack([limits[:-1], limits[1:]], axis=1)
+    # The array is shared across calls, so make sure nobody changes it
+    limits.flags.writeable = False
+    return limits
 
 
 def ECE(log_probs, target, M=15, return_values=False):
@@ -119,32 +266,13 @@ def ECE(log_probs, target, M=15, return_values=False):
         confs = probs
         preds = probs >= 0.5
 
-    # Generate intervals
-    limits = np.linspace(0, 1, num=M+1)
-    lows, highs = limits[:-1], limits[1:]
-    ece = 0
-    ave_accs = []
-    ave_confs = []
-    counts = []
-    limits_used = []
-    for low, high in zip(lows, highs):
-        ix = (low < confs) & (confs <= high)
-        n = torch.sum(ix)
-        if n==0:
-            continue
-        curr_preds = preds[ix]
-        curr_confs = confs[ix]
-        curr_target = target[ix]
-        ave_acc  = torch.mean((curr_preds == curr_target).type(dtype=probs.dtype))
-        ave_conf = torch.mean(curr_confs)
-        ave_accs.append(ave_acc.detach().numpy())
-        ave_confs.append(ave_conf.detach().numpy())
-        counts.append(n.detach().numpy())
-        limits_used.append([low, high])
-        ece += n*torch.abs(ave_conf-ave_acc)
+    # Accumulate counts, confidences and accuracies over all bins at once
+    correct = (preds == target).type(dtype=probs.dtype)
+    counts, ave_confs, ave_accs = _bin_stats(confs, correct, M)
+    ece = torch.sum(counts*torch.abs(ave_confs-ave_accs))
 
     if return_values:
-        return ece * 100/N, np.array(ave_accs), np.array(ave_confs), np.array(counts), limits_used
+        return (ece * 100/N, *_bin_values(ave_accs, ave_confs, counts, M))
     else:
         return ece * 100/N
 
@@ -159,16 +287,10 @@ def ECE_v2(log_probs, target, M=15):
 
     # Map the multi-class problem into a new binary problem of deciding whether 
     # the system made the correct prediction or not
-    log_probs2 = log_confs
-    target = preds == target
+    probs2 = torch.exp(log_confs)
+    target = (preds == target).double()
 
-    # Calibrate the scores with histogram binning, training on test data (ie, cheating)
-    log_probs2_cal, params = psrcalcal.calibrate(log_probs2, target, log_probs2, psrcalcal.HistogramBinningCal)    
-    probs2_cal = torch.exp(log_probs2_cal)
-    probs2_binned = params[0]
-
-    # Compute the average absolute difference between those two scores
-    return torch.mean(torch.abs(probs2_cal-probs2_binned)) * 100
+    return _histogram_binning_gap(probs2, target, M)
 
 
 def ECEbin(log_probs, target, M=15, return_values=False, l2norm=False):
@@ -180,34 +302,15 @@ def ECEbin(log_probs, target, M=15, return_values=False, l2norm=False):
     post2 = probs[:,1]
     target = target.double()
 
-    # Generate intervals
-    limits = np.linspace(0, 1, num=M+1)
-    lows, highs = limits[:-1], limits[1:]
-    ece = 0
-    prop2s = []
-    avep2s = []
-    counts = []
-    limits_used = []
-    for low, high in zip(lows, highs):
-        ix = (low < post2) & (post2 <= high)
-        n = torch.sum(ix)
-        if n==0:
-            continue
-        curr_post = post2[ix]
-        curr_target = target[ix]
-        avep2 = torch.mean(curr_post)
-        prop2 = torch.mean(curr_target)
-        avep2s.append(avep2.detach().numpy())
-        prop2s.append(prop2.detach().numpy())
-        counts.append(n.detach().numpy())
-        limits_used.append([low, high])
-        if l2norm:
-            ece += n*(avep2-prop2)**2
-        else:
-            ece += n*torch.abs(avep2-prop2)
+    # Accumulate counts, posteriors and class-2 proportions over all bins at once
+    counts, avep2s, prop2s = _bin_stats(post2, target, M)
+    if l2norm:
+        ece = torch.sum(counts*(avep2s-prop2s)**2)
+    else:
+        ece = torch.sum(counts*torch.abs(avep2s-prop2s))
 
     if return_values:
-        return ece * 100/N, np.array(prop2s), np.array(avep2s), np.array(counts), limits_used
+        return (ece * 100/N, *_bin_values(prop2s, avep2s, counts, M))
     else:
         return ece * 100/N
 
@@ -220,15 +323,23 @@ def ECEbin_v2(log_probs, target, M=15):
     method above."""
 
     assert log_probs.shape[1]==2
-    log_probs2 = log_probs[:,1]
+    probs2 = torch.exp(log_probs[:,1])
+    target = target.double()
 
-    # Calibrate the scores with histogram binning, training on test data (ie, cheating)
-    log_probs2_cal, params = psrcalcal.calibrate(log_probs2, target, log_probs2, psrcalcal.HistogramBinningCal)    
-    probs2_cal = torch.exp(log_probs2_cal)
-    probs2_binned = params[0]
+    return _histogram_binning_gap(probs2, target, M)
 
-    # Compute the average absolute difference between those two scores
-    return torch.mean(torch.abs(probs2_cal-probs2_binned)) * 100
+
+def _histogram_binning_gap(probs2, target, M):
+
+    # Calibrate the scores with histogram binning, training on test data (ie, cheating).
+    # The calibrated score for each sample is the proportion of targets in its bin
+    # and the binned score is the average score in its bin, so both can be obtained
+    # directly from the per-bin statistics, without going through HistogramBinningCal.
+    counts, probs2_binned, probs2_cal = _bin_stats(probs2, target, M)
+
+    # Compute the average absolute difference between those two scores over all
+    # samples, which is constant within each bin
+    return torch.sum(counts*torch.abs(probs2_cal-probs2_binned)) / probs2.shape[0] * 100
 
 
 def plot_reliability_diagram(ys, xs, counts, limits, outfile=None, title='', figsize=None):
@@ -236,6 +347,8 @@ def plot_reliability_diagram(ys, xs, counts, limits, outfile=None, title='', fig
     On the left, a reliability diagram which contains exactly the information used to compute ECE
     On the right, the standard reliability diagram.
     """
+    import matplotlib.pyplot as plt
+
     if figsize is None:
         figsize = (9,3)
     fig, [ax1, ax2] = plt.subplots(1,2,figsize=figsize)
@@ -276,8 +389,8 @@ def shift(loss, off):
 
     def shifted_loss(log_probs, labels):
         label = check_label(labels, log_probs.shape[-1])
-        qs = torch.softmax(log_probs + off, dim=1)
-        return loss(torch.log(qs), label) @ So.reshape(-1, 1)
+        log_qs = F.log_softmax(log_probs + off, dim=1)
+        return loss(log_qs, label) @ So.reshape(-1, 1)
 
     return shifted_loss
 
@@ -1,27 +1,31 @@
 from collections.abc import Iterable
 
 import torch
+import torch.nn.functional as F
 import numpy as np
 
 
 def onehot_encode(X, n_classes=None):
-    if torch.is_tensor(X):
-        X = X.detach().cpu().numpy()
-
-    N = X.shape[0]
+    if not torch.is_tensor(X):
+        X = torch.as_tensor(X)
 
     if n_classes is None:
-        n_classes = X.max()+1
+        n_classes = -1
 
-    onehot = np.zeros((N, n_classes))
-    onehot[np.arange(N), X] = 1.
+    return F.one_hot(X.long(), num_classes=n_classes)
 
-    return torch.Tensor(onehot)
 
+def softmax(x, axis=None, out=None):
+    # Done in place on a single buffer, which can be given in out to reuse it across calls
+    x = np.asarray(x)
+    if out is None:
+        # Same output dtype as np.exp would give
+        out = np.empty(x.shape, dtype=np.result_type(x.dtype, np.float16))
 
-def softmax(x, axis=None):
-    e_x = np.exp(x - np.max(x, axis=axis, keepdims=True))
-    return e_x / e_x.sum(axis=axis, keepdims=True)
+    np.subtract(x, np.max(x, axis=axis, keepdims=True), out=out)
+    np.exp(out, out=out)
+    out /= out.sum(axis=axis, keepdims=True)
+    return out
 
 
 